@@ -51,8 +51,9 @@ import os
 import re
 import shutil
 import subprocess
+import sys
 
-from collections import namedtuple
+from collections import Counter, namedtuple
 from keyword import iskeyword
 
 from docopt import docopt
@@ -68,6 +69,21 @@ parinfo = namedtuple('parinfo',
                      'in_ access association ppath vpath list_ readwrite')
 commandinfo = namedtuple('commandinfo', 'name description pardict longdescription')
 
+# Regular expressions used when parsing the .ifl and .hlp files.
+_PAR_BLOCK_RE = re.compile(r'\n\s*(parameter\b.*?)\n\s*endparameter',
+                           flags=re.I | re.DOTALL)
+_COMNAME_RE = re.compile(r'^1 [A-Z0-9]+$')
+_BULLET_RE = re.compile(r'^\s*-\s*')
+_BLANK_RE = re.compile(r'^\s*$')
+
+# Translation table to strip single and double quotes.
+_QUOTE_STRIP = str.maketrans('', '', '"\'')
+
+# The .ifl fields that are stored in a parinfo, in order.
+_IFL_FIELDS = ('type', 'prompt', 'default', 'position', 'range',
+               'in', 'access', 'association', 'ppath', 'vpath')
+_IFL_FIELDSET = frozenset(_IFL_FIELDS)
+
 picardtemplate = ["def {}(*args, **kwargs):",
                   "    \"\"\"Run PICARD'S {} recipe.\"\"\"",
                   "    return wrapper.picard('{}', *args, **kwargs)",
@@ -97,39 +113,43 @@ def generate_picard_command(ORAC_DIR):
 
 
 
+# Python type names for STARLINK types.
+_PYTYPE_MAP = {
+    '_LOGICAL': 'bool',
+    '_INTEGER': 'int',
+    '_REAL': 'float',
+    '_DOUBLE': 'float',
+    'NDF': 'str,filename',
+    'FILENAME': 'str,filename',
+    '_CHAR': 'str',
+    'LITERAL': 'str',
+}
+
 def _get_python_type(startype):
     """
     Get name of normal python type from STARLINK type.
     """
     # remove quotes
     if startype:
-        startype = startype.replace('"','').replace("'",'')
+        startype = startype.translate(_QUOTE_STRIP)
     else:
         return ''
 
-    if startype.upper() == '_LOGICAL':
-        return 'bool'
-    elif startype.upper() == '_INTEGER':
-        return 'int'
-    elif startype.upper() == '_REAL' or startype.upper() == '_DOUBLE':
-        return 'float'
-    elif startype.upper() == 'NDF' or startype.upper() == 'FILENAME':
-        return 'str,filename'
-    elif startype.upper() == '_CHAR' or startype.upper() == 'LITERAL':
-        return 'str'
-    else:
+    pytype = _PYTYPE_MAP.get(startype.upper())
+    if pytype is None:
         logger.warning('Unknown startype (%s)' % (startype))
         return startype
+    return pytype
 
 
 # Get information from an IFL file. (gets a one line prompt string,
 # which is handy for short help).
-def _ifl_parser(ifllines, parameter_info, comname='', prefer_hlp_prompt=False):
+def _ifl_parser(ifl, parameter_info, comname='', prefer_hlp_prompt=False):
 
     """Get parameter info from an ifl file for a command.
 
-    iflines should be the results of a readlines() command
-      on a command.ifl file.
+    ifl should be the contents of a command.ifl file, as a single
+      string.
 
     parameter_info is a parameter_info dict of parinfo tuples, holding
       the readwrite info if already gotten about that parameter.
@@ -141,34 +161,36 @@ def _ifl_parser(ifllines, parameter_info, comname='', prefer_hlp_prompt=False):
 
     if not parameter_info:
         return {}
-    ifl=''.join(ifllines)
 
-    # Parse IFL file to find start and end of each parameter.
-    parindices = [m.start() for m in re.finditer('\n[\s]*parameter', ifl.lower())]
-    endindices = [m.start() for m in re.finditer('\n[\s]*endparameter', ifl.lower())]
     pardict={}
 
-    # Go through each parameter
-    for i, j in zip(parindices, endindices):
+    # Go through each parameter block in the IFL file.
+    for match in _PAR_BLOCK_RE.finditer(ifl):
 
         # Get the strings for the parameter information.
-        res = ifl[i:j].strip()
-        reslist = res.split('\n')
+        reslist = match.group(1).split('\n')
 
         # Find the parname
-        parname = reslist[0].split()[1].strip().lower()
+        parname = sys.intern(reslist[0].split()[1].strip().lower())
 
-        # Get each field from the ifl string (if present).
-        fields = ['type', 'prompt', 'default', 'position', 'range',
-                  'in', 'access', 'association', 'ppath', 'vpath']
-        values = []
+        # Get each field from the ifl string (if present), using the
+        # first line that starts with the field name.
+        fields_map = {}
+        for line in reslist[1:]:
+            tok, _, rest = line.strip().replace('\t', ' ').partition(' ')
+            tok = tok.lower()
+            if tok in _IFL_FIELDSET and tok not in fields_map:
+                fields_map[tok] = rest.strip()
 
-        for a in fields:
-            val = _ifl_get_parameter_value(reslist, a)
+        values = []
+        for a in _IFL_FIELDS:
+            val = fields_map.get(a)
             if a == 'prompt' and isinstance(val, str):
                 val = val.strip("'")
             elif isinstance(val, str):
-                val = val.replace("'",'').replace('"','')
+                # These come from a small set of values (types, access
+                # modes, paths), so share a single copy of each.
+                val = sys.intern(val.translate(_QUOTE_STRIP))
             values.append(val)
 
         # If using hlp file prompts in preference to ifl prompts,
@@ -198,21 +220,6 @@ def _ifl_parser(ifllines, parameter_info, comname='', prefer_hlp_prompt=False):
     return pardict
 
 
-def _ifl_get_parameter_value(paramlist, value):
-
-    """
-    Get the value of a parameter (as a string).
-    """
-    findvalues = [s for s in paramlist if s.strip().lower().startswith(value)]
-    regex = re.compile(r"\s*" + value+ "\s*", flags=re.I)
-    if findvalues:
-        result = regex.split(findvalues[0])[1].strip()
-    else:
-        result = None
-
-    return result
-
-
 def get_module_info(hlp, iflpath, create_longhelp=False):
 
     """
@@ -228,28 +235,30 @@ def get_module_info(hlp, iflpath, create_longhelp=False):
     If create_longhelp is true, also returns a dictionary of long helps for each command line
     """
 
+    # Find all the ifl files with a single walk of the directory tree.
+    iflfiles = find_starlink_paths(iflpath, '.ifl')
+
     logger.debug('Creating list of commandnames from hlp file')
-    matchcommandname = re.compile('^1 [A-Z0-9]+$')
-    comnames = [i for i in hlp if matchcommandname.search(i)]
+    com_positions = [(idx, line) for idx, line in enumerate(hlp)
+                     if _COMNAME_RE.search(line)]
+    comcounts = Counter(line for idx, line in com_positions)
     moduledict={}
 
 
     longhelp = {}
-    for i in range(len(comnames)):
-        comname = comnames[i].split()[1].strip().lower()
-        comindex = hlp.index(comnames[i])
-        if i < (len(comnames) - 1):
-            # Deal with repeated command names.
-            repeats = comnames.count(comnames[i])
-            if repeats != 1:
-                logger.warning('Command %s appears %i times in the .hlp file' %(comname, repeats))
-
-                # Find real end of command.
-                nextcomindex = comindex + hlp[comindex+1:].index(comnames[i+1])
-            else:
-                nextcomindex = hlp.index(comnames[i+1])
+    for k, (comindex, line) in enumerate(com_positions):
+        comname = line.split()[1].strip().lower()
+
+        # Deal with repeated command names.
+        repeats = comcounts[line]
+        if repeats != 1:
+            logger.warning('Command %s appears %i times in the .hlp file' %(comname, repeats))
+
+        # The command ends where the next one starts.
+        if k + 1 < len(com_positions):
+            nextcomindex = com_positions[k+1][0]
         else:
-            nextcomindex = -1
+            nextcomindex = len(hlp)
 
         commanddoc = hlp[comindex:nextcomindex]
         comdescrip = commanddoc[1].strip()
@@ -259,33 +268,44 @@ def get_module_info(hlp, iflpath, create_longhelp=False):
 
             longhelp[comname] = commanddoc
 
-        try:
-            descripindex = commanddoc.index('Description:\n')
-            parindex = commanddoc.index('2 Parameters\n')
+        # Find the description, the parameters section and the section
+        # following the parameters in a single pass.
+        descripindex = None
+        parindex = None
+        nextindex = len(commanddoc)
+        for idx, docline in enumerate(commanddoc):
+            if parindex is None:
+                if docline == '2 Parameters\n':
+                    parindex = idx
+                elif docline == 'Description:\n' and descripindex is None:
+                    descripindex = idx
+            elif docline.startswith('2'):
+                nextindex = idx
+                break
+
+        if descripindex is not None and parindex is not None:
             description = commanddoc[descripindex+1:parindex]
             description = [i.lstrip().rstrip('\n') for i in description] + ['']
             if description[0] == '':
                 description = description[1:]
-        except:
+        else:
             logger.warning('Could not find description in .hlp file for {}'.format(comname))
             description = None
 
         try:
-            parindex = commanddoc.index('2 Parameters\n')
-            try:
-                nextsec = [i for i in commanddoc[parindex+1:] if i.startswith('2')][0]
-                nextindex = commanddoc.index(nextsec)
-            except IndexError:
-                nextindex = -1
-            parameter_introlines = [i for i in commanddoc[parindex+1:nextindex] if i[0] == '3']
+            if parindex is None:
+                raise ValueError('No parameters section for {}'.format(comname))
+            parameter_introlines = [(idx, i) for idx, i in
+                                    enumerate(commanddoc[parindex+1:nextindex], start=parindex+1)
+                                    if i[0] == '3']
 
             # Deal with the fact htat sometimes parameter info has a
             # second line like 'IN1 = NDF (Read)', and if so we want
             # to get it. Otherwise just use the first line with '3 '
             # stripped of.
             parameters = []
-            for i in parameter_introlines:
-                secondline = commanddoc[commanddoc.index(i)+1]
+            for idx, i in parameter_introlines:
+                secondline = commanddoc[idx+1] if idx+1 < len(commanddoc) else ''
                 if '=' in secondline:
                     parameters.append(secondline)
                 else:
@@ -327,15 +347,16 @@ def get_module_info(hlp, iflpath, create_longhelp=False):
         moduledict[comname] = commandinfo(comname, comdescrip, parameter_info, description)
 
         # find ifl file
-        try:
-            ifl = find_starlink_file(iflpath, comname + '.ifl')
-            logger.debug('Parsing ifl file')
-            parameter_info = _ifl_parser(ifl, parameter_info, comname=comname, prefer_hlp_prompt=False)
-            logger.debug('Creating command info')
-            moduledict[comname] = commandinfo(comname, comdescrip, parameter_info, description)
-
-        except IOError:
+        iflfile = iflfiles.get(comname + '.ifl')
+        if iflfile is None:
             logger.warning('no ifl file found for %s' % comname)
+            continue
+        with open(iflfile, 'r') as f:
+            ifl = f.read()
+        logger.debug('Parsing ifl file')
+        parameter_info = _ifl_parser(ifl, parameter_info, comname=comname, prefer_hlp_prompt=False)
+        logger.debug('Creating command info')
+        moduledict[comname] = commandinfo(comname, comdescrip, parameter_info, description)
 
     if create_longhelp:
         return moduledict, longhelp
@@ -449,6 +470,17 @@ def formatkeyword(vals, style='numpy', default=True):
             doc[0] += ':\n{}'.format(promptstring)
     return doc
 
+def _add_docsection(doc, heading, parameters, kstyle, default=True):
+    """
+    Append a numpy style section for a list of parinfo objects to doc.
+    """
+    doc.extend([heading, '-'*len(heading)])
+    for val in parameters:
+        doc.extend(formatkeyword(val, style=kstyle, default=default))
+        doc.append('')
+    doc.append('')
+
+
 def make_docstrings(moduledict, sunname=None, kstyle='numpy', uselongerdescription=False):
 
     """
@@ -462,7 +494,7 @@ def make_docstrings(moduledict, sunname=None, kstyle='numpy', uselongerdescripti
         doc = [info.description + '\n']
         longdescription = info.longdescription
         if longdescription and uselongerdescription:
-            doc = doc + longdescription
+            doc.extend(longdescription)
 
         param = info.pardict
 
@@ -482,15 +514,12 @@ def make_docstrings(moduledict, sunname=None, kstyle='numpy', uselongerdescripti
                 if not i.access:
                     readwrite = 'UPDATE'
                 if readwrite:
-                    readwrite = readwrite.lower().replace("'",'').replace('"','')
+                    readwrite = readwrite.lower().translate(_QUOTE_STRIP)
 
                 # If dynamic is start of vpath, and there is no
                 # default, replace the default with 'dyn.'
                 if i.vpath and i.vpath.startswith('DYNAMIC'):
-                    default = 'dyn.'
-                    temp = list(i)
-                    temp[3] = default
-                    i = parinfo(*temp)
+                    i = i._replace(default='dyn.')
 
 
                 # If NOPROMPT is in the path issue a warning.
@@ -532,34 +561,25 @@ def make_docstrings(moduledict, sunname=None, kstyle='numpy', uselongerdescripti
 
         if  positional:
 
+            # Sort positional args by position (parsing each one once).
+            keyed = sorted([(int(i.position), i) for i in positional], key=lambda x: x[0])
+            positional = [i for p, i in keyed]
+
             # Positional kwargs must have list of indexes without gap.
-            positions = [int(i.position) for i in positional]
-            positions.sort()
-            if max(positions) != len(positions):
+            if keyed[-1][0] != len(keyed):
                 logger.debug('command {} has improbably positional arguments'.format(name))
                 logger.debug([(i.name, i.position) for i in positional])
                 logger.debug('Moving impossible positional arguments to keyword args.'.format(name))
                 # find positional parameters that need to be moved:
-                missing_index = min([i for i in range(1,len(positions)+1) if i not in positions])
-                parameters_to_move = [i for i in positional if int(i.position) >= missing_index]
-                for p in parameters_to_move:
-                    positional.remove(p)
-                    inputpar.append(p)
+                positions = set(p for p, i in keyed)
+                missing_index = min([i for i in range(1,len(keyed)+1) if i not in positions])
+                inputpar.extend(i for p, i in keyed if p >= missing_index)
+                positional = [i for p, i in keyed if p < missing_index]
 
 
         if positional:
-            heading = 'Arguments'
-            heading = [heading, '-'*len(heading)]
-            doc += heading
-
-            # sort positional
-            positional = sorted(positional, key=lambda x: x.position)
             names = [i.name + '_' if iskeyword(i.name) else i.name for i in positional]
-            for val in positional:
-                valdoc = formatkeyword(val, style=kstyle)
-                doc += valdoc
-                doc += ['']
-            doc +=['']
+            _add_docsection(doc, 'Arguments', positional, kstyle)
 
             callsignature = ', '.join(names) + ', **kwargs'
         else:
@@ -567,45 +587,26 @@ def make_docstrings(moduledict, sunname=None, kstyle='numpy', uselongerdescripti
 
         if inputpar:
             # sort based on position then alphabet
-            inputpar = sorted(inputpar, key=lambda x: x.name)
-            inputpar = sorted(inputpar, key=lambda x: int(x.position) if
-                              x.position is not None else 1000, reverse=False)
-
-            heading = 'Keyword Arguments'
-            heading = [heading, '-'*len(heading)]
-            doc += heading
-
-            for val in inputpar:
-                valdoc = formatkeyword(val, style=kstyle)
-                doc += valdoc
-                doc += ['']
-            doc += ['']
+            inputpar = sorted(inputpar, key=lambda x: (int(x.position) if
+                                                       x.position is not None else 1000,
+                                                       x.name))
+            _add_docsection(doc, 'Keyword Arguments', inputpar, kstyle)
 
 
         if outputpar:
-            heading = 'Returns'
-            heading = [heading, '-'*len(heading)]
-            doc += heading
-
             outputpar = sorted(outputpar, key=lambda x: x.name)
-
-            for val in outputpar:
-                valdoc = formatkeyword(val, default=False, style=kstyle)
-                doc += valdoc
-                doc += ['']
-            doc += ['']
+            _add_docsection(doc, 'Returns', outputpar, kstyle, default=False)
 
 
         if sunname:
             # Add Note section with SUN documentation.
             heading = 'Notes'
-            heading = [heading, '-'*len(heading)]
-            doc += heading
+            doc.extend([heading, '-'*len(heading)])
             sunurl = 'http://www.starlink.ac.uk/cgi-bin/htxserver/{}.htx/{}.html?xref_{}'.format(
                 sunname, sunname, name.upper())
-            doc += ['See {}\nfor full documentation of this command in the latest Starlink release'.format(
-                sunurl)]
-            doc += ['']
+            doc.append('See {}\nfor full documentation of this command in the latest Starlink release'.format(
+                sunurl))
+            doc.append('')
 
         if 'device' in [i.name for i in positional]:
             device = True
@@ -627,8 +628,8 @@ def indent_lists(text):
     is '-', and previous line is blank and following line is blank.
     """
     text = text.split('\n')
-    matchbullet = re.compile('^[\s]*-[\s]*')
-    matchblank = re.compile('^[\s]*$')
+    matchbullet = _BULLET_RE
+    matchblank = _BLANK_RE
     inbullet = False
 
     # Go through each line
@@ -708,10 +709,17 @@ def create_module(module, names, docstrings, commanddict):
 
 def get_command_paths(shfile, comnames, modulename):
     commanddict = {}
+
+    # Index the shell function definitions by name.
+    shindex = {}
+    for line in shfile:
+        name = line.split('()')[0].strip()
+        if name and line.startswith(name):
+            shindex.setdefault(name, []).append(line)
+
     for c in comnames:
         # find the line in the shfile
-        lines = [i for i in shfile if i.startswith(c)]
-        lines = [i for i in lines if i.split('()')[0].strip() == c]
+        lines = shindex.get(c, [])
         if lines:
             if len(lines) > 1:
                 logger.warning('Found multiple commandlines  for %s: , %s' %(c, str(lines)))
@@ -737,7 +745,10 @@ def get_command_paths(shfile, comnames, modulename):
 
 
 
-def find_starlink_file(rootpath, filename):
+def find_starlink_path(rootpath, filename):
+    """
+    Return the path of the first file called filename under rootpath.
+    """
     walk = os.walk(rootpath)
     files = [os.path.join(root, filename) for root, dirs, files in walk if filename in files]
 
@@ -751,7 +762,35 @@ def find_starlink_file(rootpath, filename):
 
     path = files[0]
     logger.debug('Using {} file.'.format(path))
-    f = open(path, 'r')
+    return path
+
+
+def find_starlink_paths(rootpath, extension):
+    """
+    Return a dict of the paths of all files ending in extension under
+    rootpath, keyed by filename.
+
+    As for find_starlink_path, the first one found is used if there
+    are multiples.
+    """
+    paths = {}
+    for root, dirs, files in os.walk(rootpath):
+        for filename in files:
+            if not filename.endswith(extension):
+                continue
+            if filename in paths:
+                logger.warning('Found multiple {} files under directory {}: using {}'.format(
+                    filename, rootpath, paths[filename]))
+            else:
+                paths[filename] = os.path.join(root, filename)
+    return paths
+
+
+def find_starlink_file(rootpath, filename):
+    """
+    Return the lines of the first file called filename under rootpath.
+    """
+    f = open(find_starlink_path(rootpath, filename), 'r')
     filecontents = f.readlines()
     f.close()
     return filecontents
@@ -844,7 +883,7 @@ if __name__ == '__main__':
 
 
         helpfile = find_starlink_file(rootpath, modulename.lower() + '.hlp')
-        shfile = find_starlink_file(rootpath, modulename.lower() + '.sh')
+        shpath = find_starlink_path(rootpath, modulename.lower() + '.sh')
 
         # Parse the .hlp and .ifl files to get a dictionary of commands
         # and parameters (with parinfo namedtuples to describe parameter), as well as the longhelp
@@ -879,7 +918,8 @@ if __name__ == '__main__':
                 moduledict.pop(helpname)
 
         # Parse the shfile to get the actual commands that are being run.
-        commanddict = get_command_paths(shfile, moduledict.keys(), modulename)
+        with open(shpath, 'r') as shfile:
+            commanddict = get_command_paths(shfile, moduledict.keys(), modulename)
 
         # Create the docstrings for every command.
         docstrings = make_docstrings(moduledict, sunnames.get(modulename.lower(), None), kstyle='numpy')
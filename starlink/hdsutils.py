@@ -5,6 +5,14 @@ import itertools
 
 from starlink import hds
 
+# Cache of result classes, keyed by (comname, fields). Building a
+# namedtuple class is slow, and most commands are called repeatedly
+# with the same set of parameters.
+_starresults_classes = {}
+
+# Cache of HDS component names to python safe names.
+_clean_names = {}
+
 def get_adam_hds_values(comname, adamdir):
 
     """
@@ -16,45 +24,13 @@ def get_adam_hds_values(comname, adamdir):
     try:
         hdsobj = hds.open(filename, 'READ')
         # Iterate through it to get all the results.
-        results = _hds_iterate_components(hdsobj)
+        results = _hds_iterate_components(hdsobj, toplevel=True)
 
         # Remove the 'ADAM_DYNDEF' component as it never exists?
         if 'adam_dyndef' in  results:
             results.pop('adam_dyndef')
 
-        # Fix up the nameptr values (if they are the only thing in the
-        # dictionary)
-        fixuplist = [i for i in results.keys()
-                     if (isinstance(results[i], dict)
-                         and list(results[i].keys())==['nameptr'])]
-
-        for i in fixuplist:
-            results[i] = results[i]['nameptr']
-
-        for key in results:
-            value = results[key]
-
-            #This code is to ensure that on python3 we call 'decode'
-            #so as to return byte strings. Currently this is calling
-            #with 'ascii', as I believe HDS only has ascii?
-
-            if (isinstance(value, bytes) and not isinstance(value, str)):
-                results[key] = value.decode(encoding='ascii', errors='replace')
-            elif (isinstance(value, bytes) and isinstance(value, str)):
-                pass
-            else:
-                try:
-                    results[key] = [j.decode(encoding='ascii', errors='replace')
-                                    if isinstance(j, bytes) and not isinstance(j, str)
-                                    else j for j in value]
-                except (TypeError, AttributeError):
-                    pass
-
-        class starresults( namedtuple(comname, results.keys()) ):
-            def __repr__(self):
-                return _hdstrace_print(self)
-
-        result = starresults(**results)
+        result = _get_starresults_class(comname, tuple(results.keys()))(**results)
     except IOError:
         result = None
 
@@ -62,6 +38,23 @@ def get_adam_hds_values(comname, adamdir):
 
 
 
+def _get_starresults_class(comname, fields):
+    """
+    Return a namedtuple class for the given command and fields.
+
+    The class pretty-prints itself with _hdstrace_print.
+    """
+    key = (comname, fields)
+    starresults = _starresults_classes.get(key)
+    if starresults is None:
+        class starresults( namedtuple(comname, fields) ):
+            __slots__ = ()
+            def __repr__(self):
+                return _hdstrace_print(self)
+        _starresults_classes[key] = starresults
+    return starresults
+
+
 def _hds_value_get(hdscomp):
     """
     Get a value from an HDS component.
@@ -71,27 +64,29 @@ def _hds_value_get(hdscomp):
 
     Return tuple of name, value and type.
     """
-    name = hdscomp.name.lower()
-    if iskeyword(name):
-        name += '_'
+    name = _hds_get_clean_name(hdscomp.name)
     value = hdscomp.get()
 
-    # Remove white space from string objects.
+    # Remove white space from string objects, and decode them.
     if 'char' in hdscomp.type.lower():
         if hdscomp.shape:
-            value = [i.strip() for i in value]
+            value = [_hds_decode(i.strip()) for i in value]
         else:
-            value = value.strip()
+            value = _hds_decode(value.strip())
 
     type_ = hdscomp.type
     return name, value, type_
 
 
-def _hds_iterate_components(hdscomp):
+def _hds_iterate_components(hdscomp, toplevel=False):
     """
     Iterate through HDS structure.
 
     Return nested dictionaries/arrays representing the object.
+
+    If toplevel is True, the components are the parameters of an ADAM
+    file: structures holding only a NAMEPTR are replaced by its value,
+    and arrays are returned as lists.
     """
     results_dict={}
     name = _hds_get_clean_name(hdscomp.name)
@@ -102,9 +97,17 @@ def _hds_iterate_components(hdscomp):
             subcomp = hdscomp.index(i)
             if subcomp.struc and not subcomp.shape:
                 name = _hds_get_clean_name(subcomp.name)
+                if toplevel and subcomp.ncomp == 1:
+                    nameptr = subcomp.index(0)
+                    if nameptr.name.lower() == 'nameptr' and not nameptr.struc:
+                        results_dict[name] = _hds_value_get(nameptr)[1]
+                        continue
                 results_dict[name] = _hds_iterate_components(subcomp)
             elif not(subcomp.struc):
                 name, value, type_ = _hds_value_get(subcomp)
+                # Parameter arrays are returned as lists.
+                if toplevel and subcomp.shape and not isinstance(value, list):
+                    value = list(value)
                 results_dict[name] = value
             elif subcomp.struc and subcomp.shape:
                 name = _hds_get_clean_name(subcomp.name)
@@ -120,11 +123,33 @@ def _hds_iterate_components(hdscomp):
     return results_dict
 
 
+def _hds_decode(value):
+    """
+    Decode a byte string from an HDS _CHAR value.
+
+    This is so that on python3 we return strings rather than
+    bytes. Currently this is decoding with 'ascii', as I believe HDS
+    only has ascii?
+    """
+    if isinstance(value, bytes):
+        return value.decode(encoding='ascii', errors='replace')
+    return value
+
+
 def _hds_get_clean_name(name):
-    name = name.lower()
-    if iskeyword(name):
-        name += '_'
-    return name
+    """
+    Return a lowercase version of an HDS name that is safe to use in python.
+
+    Results are cached, as the same ADAM parameter names turn up on
+    every call.
+    """
+    cleanname = _clean_names.get(name)
+    if cleanname is None:
+        cleanname = name.lower()
+        if iskeyword(cleanname):
+            cleanname += '_'
+        _clean_names[name] = cleanname
+    return cleanname
 
 
 def _hds_arrays_structures(hdscomp):
@@ -141,22 +166,31 @@ def _hdstrace_print(results):
     """
     Print the results of get_adam_hds_values prettily.
     """
-    output = []
     if results:
-        maxlength = len(max(results._fields, key=len))
+        maxlength = max(map(len, results._fields))
         space = 4
 
-        for i in results._asdict().items():
-
-            if isinstance(i[1], list) and len(str(i[1])) > 79 - maxlength - space:
-                j = ['['+' ' + str(i[1][0])] +  \
-                    [' '*(maxlength+space+2) + str(n) for n in i[1][1:]] + \
-                    [' '*(maxlength+space) + ']']
-                value = '\n'.join(j)
-            else:
-                value = i[1]
-            output.append('{:>{width}}'.format(str(i[0]), width=maxlength) + ' '*space + str(value))
-        return '\n'.join(output)
+        # Padding used for every line, worked out once.
+        prefix_fmt = '{:>%d}' % maxlength + ' '*space
+        indent = ' '*(maxlength+space+2)
+        closer = ' '*(maxlength+space) + ']'
+        width = 79 - maxlength - space
+
+        return '\n'.join([prefix_fmt.format(str(key)) +
+                          _hdstrace_format_value(value, width, indent, closer)
+                          for key, value in results._asdict().items()])
     else:
         return ''
 
+
+def _hdstrace_format_value(value, width, indent, closer):
+    """
+    Format a single value for _hdstrace_print, wrapping long lists.
+    """
+    if isinstance(value, list) and len(str(value)) > width:
+        j = ['['+' ' + str(value[0])] +  \
+            [indent + str(n) for n in value[1:]] + \
+            [closer]
+        return '\n'.join(j)
+    else:
+        return str(value)
@@ -20,19 +20,16 @@ Convenience utilities when using Starlink in python.
 
 import logging
 import os
-import pydoc
 from inspect import getmembers, isfunction
 
-try:
-    from itertools import imap
-except ImportError:
-    imap = map
-
 
 from starlink import hds
 
 logger = logging.getLogger(__name__)
 
+# Cache of one line docstring summaries, keyed by function.
+_function_summaries = {}
+
 
 
 def get_ndf_fitshdr(datafile):
@@ -50,12 +47,18 @@ def get_ndf_fitshdr(datafile):
 
     hdsobj = hds.open(datafile, 'READ')
     fitscomp = hdsobj.find('MORE').find('FITS')
-    fitsheader = fitscomp.get()
-    fitsheader = '\n'.join([i.decode()
-                            if isinstance(i, bytes) and not isinstance(i, str)
-                            else i
-                            for i in fitsheader])
-    hdr = fits.Header.fromstring(fitsheader, sep='\n')
+    cards = fitscomp.get()
+
+    # The cards are fixed width (_CHAR*80). If HDS has returned them
+    # as a numpy byte string array its buffer is already the 80
+    # character records astropy expects; otherwise join them into one.
+    dtype = getattr(cards, 'dtype', None)
+    if dtype is not None and dtype.kind == 'S' and dtype.itemsize == 80:
+        fitsheader = cards.tobytes()
+    else:
+        fitsheader = b''.join([(i if isinstance(i, bytes) else i.encode('ascii')).ljust(80)
+                               for i in cards])
+    hdr = fits.Header.fromstring(fitsheader)
 
     return hdr
 
@@ -65,23 +68,36 @@ def get_module_function_summary(module):
     Return a summary of module functions
     """
     functionslist = getmembers(module, isfunction)
-    summaries = {}
-    for f in functionslist:
-        summaries[f[0]] = next(s for s in f[1].__doc__.split('\n') if s)
-    width = max(imap(len, summaries))
-    keys = list(summaries.keys())
-    keys.sort()
-    return '\n'.join( ['{:<{width}}: {}'.format(key, summaries[key], width=width+1) for key in keys])
+    summaries = dict((name, _get_function_summary(f)) for name, f in functionslist)
+    width = max(map(len, summaries)) + 1
+    return '\n'.join(['{:<{width}}: {}'.format(key, summaries[key], width=width)
+                      for key in sorted(summaries)])
+
+
+def _get_function_summary(function):
+    """
+    Return the first non-empty line of a function's docstring.
+
+    Results are cached, as the generated command docstrings are long.
+    """
+    summary = _function_summaries.get(function)
+    if summary is None:
+        summary = next((s for s in (function.__doc__ or '').split('\n', 16) if s), '')
+        _function_summaries[function] = summary
+    return summary
 
 
-import inspect
 from types import FunctionType, ModuleType
-from pkg_resources import resource_filename
 
 def starhelp(myobj):
     """
     Get long help on a starlink module or command.
     """
+    # Only imported here, as pkg_resources is slow to import and
+    # starhelp is only used interactively.
+    import pydoc
+    from pkg_resources import resource_filename
+
     # For modules, return the summary of the module.
     if isinstance(myobj, ModuleType):
         doc = get_module_function_summary(myobj)
@@ -94,14 +110,13 @@ def starhelp(myobj):
                                      os.path.join(dirname, functionname+'.rst')
                                      )
         if os.path.isfile(filename):
-            f = open(filename, 'r')
-            doc = f.readlines()
-            f.close()
+            with open(filename, 'r', errors='replace') as f:
+                doc = f.read()
         else:
-            raise Exception('starhelp could not find file {} on disk.'.format(filename))
+            raise IOError('starhelp could not find file {} on disk.'.format(filename))
     else:
-        raise Exception('starhelp cannot evalute object {}.'.format(myobj))
-    pydoc.pager(''.join(doc))
+        raise TypeError('starhelp cannot evalute object {}.'.format(myobj))
+    pydoc.pager(doc)
 
 
 
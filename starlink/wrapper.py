@@ -39,7 +39,14 @@ returning values from a previous run, it will delete the
 <commandname>.sdf files from the ADAM directory after reading them
 back in. This also means it will not remember which options you used
 on the previous call to the command (unlike the command line
-Starlink).
+Starlink). Commands run from other threads each get a temporary ADAM
+directory that no other running command is using, so they can be run
+in parallel; GLOBAL and AGI state is not shared between them.
+
+Every command is run as a new process. Starlink monoliths (e.g.
+kappa_mon) pick the application to run from the name they were
+invoked by and exit once it has finished; keeping one running between
+commands would need the ADAM message system, as used by ICL.
 
 This code was written to allow quick calling of kappa, smurf and cupid
 in a more 'pythonic' way.
@@ -49,12 +56,14 @@ import atexit
 import glob
 import logging
 import os
+import re
 import shutil
 import signal
 import subprocess
 import sys
 import time
 import tempfile
+import threading
 
 try:
     basestring=basestring
@@ -62,6 +71,8 @@ except NameError:
     basestring=(str, bytes)
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 from . import hdsutils
@@ -76,8 +87,9 @@ default_starpath = None
 
 
 # Subprocess fix for sig pipe. This attempts to solve zombie monolith problem.
-# TODO check if this should be used.
-# Graham thinks it should be given to preexec_fn.
+# Not passed as preexec_fn: that forces fork+exec instead of
+# posix_spawn, and on Python 3 the default restore_signals=True
+# already resets SIGPIPE and SIGXFSZ in the child.
 def subprocess_setup():
     # Python installs a SIGPIPE handler by default. This is usually
     # not what non-Python subprocesses expect.
@@ -105,82 +117,26 @@ condict = {
     'GIF(.gif),TIFF(.tif),GASP(.hdr),COMPRESSED(.sdf.Z),GZIP(.sdf.gz),'
     'FITSGZ(.fts.gz),FITSGZ(.fits.gz)',
 
-    'NDF_FROM_ASCII': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_COMPRESSED': "$CONVERT_DIR/convertndf from '^fmt' '^dir' "
-    "'^name' '^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_FIGARO': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_FITS': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_FITSGZ': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name'"
-    " '^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_GASP': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_GIF': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_GZIP': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_IRAF': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_STREAM': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_TEXT': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_TIFF': "$CxsONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_UNF0': "$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-
-    'NDF_FROM_UNFORMATTED': "$CONVERT_DIR/convertndf from '^fmt' '^dir' "
-    "'^name' '^type' '^fxs' '^ndf'",
-
     'NDF_SHCVT': '0',
     'NDF_TEMP_COMPRESSED': 'temp_Z_^namecl',
     'NDF_TEMP_FITS': 'temp_fits_^namecl^fxscl',
     'NDF_TEMP_GZIP': 'temp_gz_^namecl',
-    'NDF_TO_ASCII': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_COMPRESSED': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_FIGARO': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_FITS': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_FITSGZ': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_GASP': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_GIF': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_GZIP': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_IRAF': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_STREAM': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_TEXT': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_TIFF': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_UNF0': "$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
-    "'^type' '^fxs' '^ndf'",
-    'NDF_TO_UNFORMATTED': "$CONVERT_DIR/convertndf to '^fmt' '^dir' "
-    "'^name' '^type' '^fxs' '^ndf'"
     }
 
+# Every NDF_FROM_<fmt> and NDF_TO_<fmt> variable runs the same
+# convertndf command, so they all share a single string.
+convert_formats = ('ASCII', 'COMPRESSED', 'FIGARO', 'FITS', 'FITSGZ', 'GASP',
+                   'GIF', 'GZIP', 'IRAF', 'STREAM', 'TEXT', 'TIFF', 'UNF0',
+                   'UNFORMATTED')
+_convert_from = ("$CONVERT_DIR/convertndf from '^fmt' '^dir' '^name' "
+                 "'^type' '^fxs' '^ndf'")
+_convert_to = ("$CONVERT_DIR/convertndf to '^fmt' '^dir' '^name' "
+               "'^type' '^fxs' '^ndf'")
+for _fmt in convert_formats:
+    condict['NDF_FROM_' + _fmt] = _convert_from
+    condict['NDF_TO_' + _fmt] = _convert_to
+del _fmt
+
 # Starlink environ variables that are relative to STARLINK_DIR
 starlink_environdict_substitute = {
     "ATOOLS_DIR": "bin/atools",
@@ -218,6 +174,13 @@ starlink_environdict_substitute = {
     "STARLINK_DIR": "",
 }
 
+# Matches $NAME or ${NAME} for any of the above variables (longest
+# names first, so that no name can match part of a longer one).
+_starlink_variable_names = '|'.join(
+    re.escape(i) for i in sorted(starlink_environdict_substitute, key=len, reverse=True))
+_starlink_variable_regex = re.compile(
+    r'\$(?:\{(' + _starlink_variable_names + r')\}|(' + _starlink_variable_names + r'))')
+
 
 # Not setting up the _HELP directories.
 # Also not setting up: ADAM_PACKAGES, ICL_LOGIN_SYS, FIG_HTML, PONGO_EXAMPLES,
@@ -231,6 +194,9 @@ starlink_other_variables = {
     "SYS_SPECX": "share/specx",
     }
 
+# Variables copied from the user's environment.
+passthrough_variables = ('DISPLAY', 'HOME', 'LANG', 'TERM', 'USER')
+
 xwindow_names = {
     "xw" : "xwindows",
     "x2w" : "xwindows2",
@@ -243,6 +209,17 @@ xwindow_names = {
 }
 
 
+# Environment variables that don't depend on the Starlink path.
+static_environ = {
+    # Produce error codes if starlink command fails.
+    # Note that this will still only write error messages to stdin,
+    # not to stderr.
+    'ADAM_EXIT': '1',
+    # don't let the MERS library split long lines?
+    'MSG_SZOUT': '0',
+}
+
+
 # Return type for PICARD and ORAC-DR
 oracoutput = namedtuple('oracoutput', 'runlog outdir datafiles imagefiles logfiles status pid')
 
@@ -253,63 +230,61 @@ def setup_starlink_environ(starpath, adamdir,
     Create a suitable ENV dict to pass to subprocess.Popen.
     """
 
-    env = {}
+    env = dict(static_environ)
     env['STARLINK_DIR'] = starpath
-    env['AGI_USER'] = os.path.join(adamdir)
+    env['AGI_USER'] = adamdir
+
+    # Everything below is a path inside starpath, so just prefix the
+    # relative paths with it.
+    prefix = starpath.rstrip(os.sep) + os.sep
+    pathsep = os.path.pathsep
 
     # Add on the STARLINK libraries to the environmental path
     # Skip if on Mac, where we shouldn't need DYLD_LIBRARY_PATH.
     if sys.platform != 'darwin':
-        ld_environ = 'LD_LIBRARY_PATH'
-        javapaths = [os.path.join(starpath, 'starjava', 'lib', 'amd64')]
-
-        starlib = os.path.join(starpath, 'lib')
-        starldlibpath = os.path.pathsep.join([starlib] + javapaths)
-        env[ld_environ] = starldlibpath
+        env['LD_LIBRARY_PATH'] = (prefix + 'lib' + pathsep +
+                                  prefix + os.path.join('starjava', 'lib', 'amd64'))
 
     # Don't ever prompt user for input.
     if noprompt:
         env["ADAM_NOPROMPT"] = "1"
         env["STARUTIL_NOPROMPT"] = "1"
 
-    # Produce error codes if starlink command fails.
-    # Note that this will still only write error messages to stdin,
-    # not to stderr.
-    env['ADAM_EXIT'] = '1'
-
     # Set this ADAM_USER to be used
     env['ADAM_USER'] = adamdir
 
-    # don't let the MERS library split long lines?
-    env['MSG_SZOUT'] = "0"
-
-    # Add the CONVERT environ variables to the env.
-    env.update(condict)
-
     # Set up various starlink variables.
 
+    # All the values in starlink_environdict_substitute and
+    # starlink_other_variables are simple relative paths.
+
     # Package directories -- e.g. KAPPA_DIR etc names
     for module_env, modulepath in starlink_environdict_substitute.items():
-        env[module_env] = os.path.join(starpath, modulepath)
+        env[module_env] = prefix + modulepath
+
+    # Add the CONVERT environ variables to the env, with the actual
+    # path of CONVERT_DIR filled in.
+    convertdir = env['CONVERT_DIR']
+    env.update((key, value.replace('$CONVERT_DIR', convertdir))
+               for key, value in condict.items())
 
     for environvar, relvalue in starlink_other_variables.items():
-        env[environvar] = os.path.join(starpath, relvalue)
+        env[environvar] = prefix + relvalue
 
     # Perl 5 libraries:
-    env['PERL5LIB'] = os.path.join(starpath, 'Perl', 'lib', 'perl5', 'site_perl') + \
-                      os.path.pathsep + os.path.join(starpath, 'Perl', 'lib', 'perl5')
+    perllib = prefix + os.path.join('Perl', 'lib', 'perl5')
+    env['PERL5LIB'] = perllib + os.sep + 'site_perl' + pathsep + perllib
 
     # Setting up the Path (note that we are using shell=False)
-    originalpath = os.environ.get('PATH', '')
-    env['PATH'] = os.path.pathsep.join([
-                                    os.path.join(starpath, 'bin', 'startcl'),
-                                    os.path.join(starpath, 'bin'),
-                                    os.path.join(starpath, 'starjava', 'bin'),
-                                    originalpath])
+    starbin = prefix + 'bin'
+    env['PATH'] = (starbin + os.sep + 'startcl' + pathsep +
+                   starbin + pathsep +
+                   prefix + os.path.join('starjava', 'bin') + pathsep +
+                   os.environ.get('PATH', ''))
 
-    # Add DISPLAY, for X stuff
-    if 'DISPLAY' in os.environ:
-        env['DISPLAY'] = os.environ['DISPLAY']
+    # Pass through DISPLAY (for X stuff) and basic user settings.
+    env.update((i, os.environ[i]) for i in passthrough_variables
+               if i in os.environ)
 
     return env
 
@@ -325,9 +300,135 @@ def change_starpath(starlinkdir):
     global env
     global starpath
     env = setup_starlink_environ(starlinkdir,
-                                 adamdir,
+                                 _get_main_adamdir(),
                                  noprompt=True)
     starpath = starlinkdir
+    _resolved_commands.clear()
+
+
+def _acquire_adamdir():
+    """
+    Return an ADAM directory for a starcomm call from the current thread.
+
+    The main thread always uses the module level adamdir. Other
+    threads are given a directory from a pool that no other call is
+    using, so that concurrent starcomm calls do not overwrite each
+    other's <commandname>.sdf files. Give the directory back with
+    _release_adamdir when the call has finished.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return _get_main_adamdir()
+    with _adamdir_lock:
+        if _free_adamdirs:
+            return _free_adamdirs.pop()
+        pooladamdir = tempfile.mkdtemp(prefix='tmpADAM', dir=os.getcwd())
+        _pool_adamdirs.add(pooladamdir)
+        return pooladamdir
+
+
+def _release_adamdir(calladamdir):
+    """
+    Give back a directory from _acquire_adamdir, so it can be reused.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        with _adamdir_lock:
+            _free_adamdirs.append(calladamdir)
+
+
+def _remove_pool_adamdirs(free_only=False):
+    """
+    Delete the pooled ADAM directories.
+
+    If free_only is True, directories that are being used by a
+    starcomm call are left alone.
+    """
+    with _adamdir_lock:
+        if free_only:
+            pooldirs = list(_free_adamdirs)
+        else:
+            pooldirs = list(_pool_adamdirs)
+        del _free_adamdirs[:]
+        _pool_adamdirs.difference_update(pooldirs)
+    for pooldir in pooldirs:
+        _remove_adamdir(pooldir)
+
+
+def _get_main_adamdir():
+    """
+    Return the module level adamdir, creating it on first use.
+    """
+    global adamdir
+    try:
+        return adamdir
+    except NameError:
+        pass
+    # Only let one thread create it.
+    with _adamdir_lock:
+        if 'adamdir' not in globals():
+            adamdir = _make_adamdir()
+        return adamdir
+
+
+def _make_adamdir():
+    """
+    Create a temporary ADAM directory in the current directory.
+
+    It will be automatically deleted when python closes.
+    """
+    newadamdir = tempfile.mkdtemp(prefix='tmpADAM', dir=os.getcwd())
+    atexit.register(_remove_adamdir, newadamdir)
+    return newadamdir
+
+
+def _remove_adamdir(adamdir):
+    """
+    Delete a temporary ADAM directory and its contents.
+
+    This normally only holds the <commandname>.sdf parameter files,
+    so each entry is unlinked straight from a single scandir pass;
+    anything unexpected like a subdirectory is left to shutil.rmtree.
+    """
+    try:
+        with os.scandir(adamdir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+        os.rmdir(adamdir)
+    except FileNotFoundError:
+        pass
+
+
+def _get_env():
+    """
+    Return the module level env, setting it up on first use.
+
+    Returns None if no starpath has been found.
+    """
+    global env
+    try:
+        return env
+    except NameError:
+        if not starpath:
+            return None
+    # Only let one thread set it up.
+    with _adamdir_lock:
+        if 'env' not in globals():
+            env = setup_starlink_environ(starpath, _get_main_adamdir())
+        return env
+
+
+def __getattr__(name):
+    # Set up env and adamdir when first accessed from outside this module.
+    if name == 'env':
+        return _get_env()
+    if name == 'adamdir':
+        return _get_main_adamdir()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
 
 def set_HDS_version(version):
@@ -339,8 +440,8 @@ def set_HDS_version(version):
     HDS_VERSION set in your environment before running Python.
     """
     try:
-        env['HDS_VERSION'] = str(version)
-    except NameError:
+        _get_env()['HDS_VERSION'] = str(version)
+    except TypeError:
         logger.error('No `env` found: please run change_starpath first.',
                      exc_info=1)
 
@@ -395,29 +496,33 @@ def starcomm(command, commandname, *args, **kwargs):
 
     """
 
-    # Ensure using lowercase for all kwargs.
-    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+    # Ensure using lowercase for all kwargs (only rebuilding the dict
+    # if needed, as they normally already are; islower avoids making a
+    # lowercase copy of every key just to check).
+    if not all(k.islower() for k in kwargs):
+        kwargs = dict((k.lower(), v) for k, v in kwargs.items())
 
 
     # Always allow returning the std out as a string:
-    if 'returnstdout' in kwargs:
-        returnStdOut = kwargs.pop('returnstdout')
-    else:
-        returnStdOut = False
-
-    # Turn args and kwargs into a single list appropriate for sending to
-    # subprocess.Popen.
-    arg = _make_argument_list(*args, **kwargs)
+    returnStdOut = kwargs.pop('returnstdout', False)
 
+    # Take an ADAM directory for this call (see _acquire_adamdir); it
+    # is given back at the end.
+    adamdir = _acquire_adamdir()
 
     # Now try running the command.
     try:
-        # Replace things like ${KAPPA_DIR} and $KAPPA_DIR with the
-        # KAPPA_DIR value.
-        for i, j in starlink_environdict_substitute.items():
-            command = command.replace('$' + i, env[i])
-            command = command.replace('${' + i + '}', env[i])
+        # The module level env is only looked up once; it is only
+        # copied if this is not the main thread.
+        callenv = _get_env()
+        if callenv['ADAM_USER'] != adamdir:
+            callenv = dict(callenv, ADAM_USER=adamdir, AGI_USER=adamdir)
+
+        command = _resolve_command(command, callenv)
 
+        # Turn the command, args and kwargs into a single list
+        # appropriate for sending to subprocess.Popen.
+        commandlist = _make_argument_list(command, *args, **kwargs)
 
         # Check if there is a 'device' keyword. NB this won't work if
         # it is an argument.
@@ -432,18 +537,46 @@ def starcomm(command, commandname, *args, **kwargs):
 
         if xmake:
             logger.debug('Creating xwindow named {}'.format(gdname))
-            xmakecomm = os.path.join(env['STARLINK_DIR'], 'bin', 'xmake')
+            xmakecomm = os.path.join(callenv['STARLINK_DIR'], 'bin', 'xmake')
             logger.debug('{} {}'.format(xmakecomm, gdname))
-            p=subprocess.Popen([xmakecomm, gdname], env=env)
+            p=subprocess.Popen([xmakecomm, gdname], env=callenv, close_fds=False,
+                               restore_signals=True)
             p.wait()
 
-        logger.debug([command] + arg)
-        proc = subprocess.Popen([command] + arg, env=env, shell=False,
-                                stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        status = proc.returncode
-        if stderr:
-            logger.info(stderr)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(commandlist)
+        # close_fds=False lets Python use posix_spawn rather than
+        # fork+exec, which is much cheaper from a large parent process.
+        # restore_signals resets SIGPIPE and SIGXFSZ to their defaults
+        # in the child, so Starlink commands in shell pipes terminate
+        # properly.
+        #
+        # stdout goes to a temporary file rather than a pipe, and is
+        # only read back if it is needed (Starlink writes its error
+        # messages there), so the often long output of commands such
+        # as makemap is not held in memory on every call.
+        with tempfile.TemporaryFile() as stdoutfile:
+            proc = subprocess.Popen(commandlist, env=callenv, shell=False,
+                                    close_fds=False, restore_signals=True,
+                                    stderr=subprocess.PIPE, stdout=stdoutfile)
+            try:
+                stderr = proc.communicate()[1]
+            except BaseException:
+                # Don't leave the command running if we are
+                # interrupted (e.g. by Ctrl-C) while waiting for it.
+                proc.kill()
+                proc.wait()
+                raise
+            status = proc.returncode
+            stdout = ''
+            if status != 0 or returnStdOut or logger.isEnabledFor(logging.DEBUG):
+                stdoutfile.seek(0)
+                stdout = stdoutfile.read().decode('utf-8', errors='replace')
+        # Only decode stderr if it is going to be logged or reported.
+        if status != 0 or logger.isEnabledFor(logging.INFO):
+            stderr = stderr.decode('utf-8', errors='replace')
+            if stderr:
+                logger.info(stderr)
 
         # If there was an error, raise a python error and print the
         # starlink output to screen.
@@ -451,15 +584,11 @@ def starcomm(command, commandname, *args, **kwargs):
             message = ('Starlink error occured during command:\n'
                        '{} {}\n '
                        'stdout and stderr are appended below.\n{}\n{}')
-            message = message.format(command, args, stdout.decode(), stderr.decode())
+            message = message.format(command, args, stdout, stderr)
 
             # Also delete the adam output file, as it may be corrupt
             # or contain something we don't want propogating.
-            adamfile = os.path.join(adamdir, commandname + '.sdf')
-            if os.path.isfile(adamfile):
-                os.remove(adamfile)
-            else:
-                logger.debug('{} does not exist'.format(adamfile))
+            _remove_adam_file(adamdir, commandname)
 
             raise Exception(message)
 
@@ -467,7 +596,7 @@ def starcomm(command, commandname, *args, **kwargs):
 
             # Show stdout as a debug log.
             if stdout:
-                logger.debug(stdout.decode())
+                logger.debug(stdout)
 
             # Get the parameters for the command from $ADAMDIR/commandname.sdf:
             result = hdsutils.get_adam_hds_values(commandname, adamdir)
@@ -484,15 +613,11 @@ def starcomm(command, commandname, *args, **kwargs):
             # returned, but it will have been returned from the
             # previous call. Using RESET does not clean out the output
             # parameters from a previous call.
-            adamfile = os.path.join(adamdir, commandname + '.sdf')
-            if os.path.isfile(adamfile):
-                os.remove(adamfile)
-            else:
-                logger.debug('{} does not exist'.format(adamfile))
+            _remove_adam_file(adamdir, commandname)
 
             # If the magic keyword returnStdOut was set:
             if returnStdOut:
-                result = (result, stdout.decode())
+                result = (result, stdout)
 
             return result
 
@@ -506,47 +631,234 @@ def starcomm(command, commandname, *args, **kwargs):
             raise err
         else:
             raise err
+    finally:
+        _release_adamdir(adamdir)
+
+
+
+def starcomm_batch(commands, workers=1):
+    """
+    Execute a sequence of Starlink applications.
+
+    Each item of commands is a tuple of (command, commandname, args,
+    kwargs), where args and kwargs are as would be passed to
+    starcomm. By default the commands are run in order, stopping at
+    the first one that fails.
+
+    If workers is more than 1, up to that many commands are run at
+    once from a pool of threads (each call with its own ADAM directory);
+    only do this if the commands do not depend on each other's
+    output. All the commands are run, and then the error from the
+    first one that failed (if any) is raised.
+
+    As each threaded call takes whichever ADAM directory is free, the
+    ADAM_USER/AGI_USER state (GLOBAL.sdf parameters such as the
+    current NDF, and AGI pictures) does not carry over from one
+    command to the next, and is not shared with the main thread. Run
+    graphics commands, or commands relying on GLOBAL values, with
+    workers=1.
+
+    Returns
+    -------
+
+       list: The result of starcomm for each command, in order.
+
+    Example
+    -------
+
+    >>> res = starcomm_batch([
+    ...     ('$KAPPA_DIR/ndfcopy', 'ndfcopy', ('myndf.sdf', 'copy.sdf'), {}),
+    ...     ('$KAPPA_DIR/stats', 'stats', (), {'ndf': 'copy.sdf'}),
+    ... ])
+
+    Notes
+    -----
 
+    Starlink monoliths choose which application to run from the name
+    they were invoked by, and only ICL can feed them a script of
+    commands, so each command is still run in its own process.
+
+    """
+    if workers > 1:
+        return _thread_map(starcomm,
+                           [((command, commandname) + tuple(args), kwargs)
+                            for command, commandname, args, kwargs in commands],
+                           workers)
+
+    return [starcomm(command, commandname, *args, **kwargs)
+            for command, commandname, args, kwargs in commands]
+
+
+def pmap(function, inputs, /, workers=None, **kwargs):
+    """
+    Run a Starlink command function over many inputs in parallel.
+
+    Each item of inputs is a tuple of positional arguments for
+    function (e.g. polpack.polvec), or a single argument. Any kwargs
+    are passed to every call. The calls are made from a pool of
+    threads: each command runs in its own process, and each call
+    has its own ADAM directory, so threads are sufficient.
+
+    As each call takes whichever ADAM directory is free, GLOBAL.sdf
+    parameters and AGI picture state do not carry over between calls,
+    and are not shared with the main thread; do not use pmap to chain
+    graphics commands or commands relying on GLOBAL values.
+
+    workers defaults to one less than the number of CPUs, as the
+    Starlink processes are usually CPU bound themselves.
+
+    function and inputs are positional-only, so Starlink parameters of
+    those names are passed on to function. A Starlink parameter called
+    WORKERS can be given in upper case, as parameter names are not
+    case sensitive.
+
+    Returns
+    -------
+
+       list: The result of each call, in the same order as inputs.
+
+    Example
+    -------
+
+    >>> results = pmap(kappa.stats, ['a.sdf', 'b.sdf', 'c.sdf'], order=True)
+
+    """
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    return _thread_map(function,
+                       [(args if isinstance(args, tuple) else (args,), kwargs)
+                        for args in inputs],
+                       workers)
+
+
+def _thread_map(function, calls, workers):
+    """
+    Call function(*args, **kwargs) for each (args, kwargs) in calls,
+    from a pool of up to workers threads.
+
+    Returns the results in order. All the calls are made, and then the
+    exception from the first one that failed (if any) is raised. The
+    ADAM directories used by the threads are deleted afterwards.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(function, *args, **kwargs)
+                       for args, kwargs in calls]
+            return [future.result() for future in futures]
+    finally:
+        _remove_pool_adamdirs(free_only=True)
+
+
+@contextmanager
+def group_file(filenames):
+    """
+    Write a list of files to a temporary Starlink group file.
+
+    Yields the '^listfile' group expression, which can be given as the
+    value of any parameter that accepts a group of NDFs (e.g. the
+    'in' parameter of polpack.polimp or kappa.wcsalign). This runs the
+    command once for all the files, rather than starting a new process
+    for each one. The list file is deleted afterwards.
+
+    Example
+    -------
+
+    >>> with group_file(['a.sdf', 'b.sdf', 'c.sdf']) as group:
+    ...     polpack.polimp(group)
+
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.lis', delete=False) as f:
+        f.write('\n'.join(filenames) + '\n')
+        listfile = f.name
+    try:
+        yield '^' + listfile
+    finally:
+        os.remove(listfile)
+
+
+def _remove_adam_file(adamdir, commandname):
+    """
+    Delete the <commandname>.sdf parameter file from adamdir.
+
+    Just tries the removal, rather than checking if the file exists
+    first, as the command normally has written one.
+    """
+    adamfile = os.path.join(adamdir, commandname + '.sdf')
+    try:
+        os.remove(adamfile)
+    except FileNotFoundError:
+        logger.debug('{} does not exist'.format(adamfile))
+
+
+def _resolve_command(command, callenv):
+    """
+    Replace things like ${KAPPA_DIR} and $KAPPA_DIR in a command
+    with the KAPPA_DIR value from callenv.
+
+    Results are cached along with the values they were made from, and
+    are worked out again if any of those have since been changed in
+    env (e.g. by setting wrapper.env['SMURF_DIR'] directly).
+    """
+    cached = _resolved_commands.get(command)
+    if cached is not None:
+        resolved, used = cached
+        if all(callenv.get(name) == value for name, value in used):
+            return resolved
+
+    used = []
+    def substitute(match):
+        name = match.group(1) or match.group(2)
+        value = callenv[name]
+        used.append((name, value))
+        return value
+
+    resolved = _starlink_variable_regex.sub(substitute, command)
+    _resolved_commands[command] = (resolved, tuple(used))
+    return resolved
 
 
 class StarError(Exception):
     def __init__(self, command, arg, stderr):
-        message = 'Starlink error occured during:\n %s %s\n ' % (commandh, arg)
+        message = 'Starlink error occured during:\n %s %s\n ' % (command, arg)
         message += '\nThere should be an error message printed to stdout '
         message += '(check above this traceback)'+stderr
         Exception.__init__(self, message)
 
 
-def _make_argument_list(*args, **kwargs):
+def _make_argument_list(command, /, *args, **kwargs):
     """
 
     Turn pythonic list of positional arguments and keyword arguments
-    into a list of strings.
+    into a list of strings, starting with the command itself.
+
+    command is positional-only, so that a Starlink parameter called
+    COMMAND can still be given as a keyword argument.
 
     N.B.: subprocess.Popen works best with each argument as item in
     list, not as a single string. Otherwise it breaks on starlink
     commands that are really python scripts.
 
     """
-    output = []
-
-    # Go through each positional argument.
-    for i in args:
-        output.append(str(i) + ' ')
+    # The command, then positional arguments, followed by keyword
+    # arguments as key=value (added in place, rather than
+    # concatenating lists).
+    output = [command]
+    output += map(str, args)
+    output += [(_keyword_prefixes.get(key) or _add_keyword_prefix(key)) + str(value)
+               for key, value in kwargs.items()]
+    return output
 
-    # Go through each keyword argument.
-    for key, value in kwargs.items():
-        # Strip out trailing '_' (used for starlink keywords that are
-        # python reserved words).
-        if key[-1] == '_':
-            key = key[:-1]
-        output.append(str(key)+'='+str(value))
 
-    # Remove trailing space
-    output = [i.rstrip() for i in output]
+def _add_keyword_prefix(key):
+    """
+    Create and cache the 'key=' prefix for a keyword argument.
 
-    # Return list of arguments (as a list).
-    return output
+    A trailing '_' is stripped from keywords (used for starlink
+    keywords that are python reserved words).
+    """
+    prefix = (key[:-1] if key.endswith('_') else key) + '='
+    _keyword_prefixes[key] = prefix
+    return prefix
 
 
 JCMTINST = ['ACSIS', 'SCUBA2_850', 'SCUBA2_450', 'SCUBA', 'JCMTDAS', ]
@@ -571,7 +883,7 @@ def oracdr_envsetup(instrument, utdate=None, ORAC_DIR=None,
     Returns an updated environment dictionary.
 
     """
-    oracenv = env.copy()
+    oracenv = _get_env().copy()
     if not utdate:
         utdate = time.strftime('%Y%M%d')
     else:
@@ -604,7 +916,7 @@ def oracdr_envsetup(instrument, utdate=None, ORAC_DIR=None,
     oracenv['ORAC_DATA_OUT'] = ORAC_DATA_OUT
 
     if not ORAC_DIR:
-        ORAC_DIR = os.path.join(env['STARLINK_DIR'], 'bin', 'oracdr', 'src')
+        ORAC_DIR = os.path.join(oracenv['STARLINK_DIR'], 'bin', 'oracdr', 'src')
     oracenv['ORAC_DIR'] = ORAC_DIR
 
     if not ORAC_PERL5LIB:
@@ -843,7 +1155,8 @@ def oracdr(instrument, loop='file', dataout=None,
 
     # Run the command.
     logger.info('Running {}.'.format(' '.join(commandlist)))
-    proc = subprocess.Popen(commandlist, env=oracenv, shell=False)
+    proc = subprocess.Popen(commandlist, env=oracenv, shell=False, close_fds=False,
+                            restore_signals=True)
     pid = proc.pid
     proc.communicate()
     status = proc.returncode
@@ -943,7 +1256,7 @@ def picard(recipe, files, dataout=None,
      - pid (int): pid of perl parent process.
 
     """
-    picardenv = env.copy()
+    picardenv = _get_env().copy()
     if not oracdir:
         picardenv['ORAC_DIR'] = os.path.join(starpath, 'bin', 'oracdr', 'src')
     else:
@@ -1009,7 +1322,8 @@ def picard(recipe, files, dataout=None,
 
     # Run the command.
     logger.info('Running {}.'.format(' '.join(commandlist)))
-    proc = subprocess.Popen(commandlist, env=picardenv, shell=False)
+    proc = subprocess.Popen(commandlist, env=picardenv, shell=False, close_fds=False,
+                            restore_signals=True)
     pid = proc.pid
     proc.communicate()
     status = proc.returncode
@@ -1063,7 +1377,13 @@ relative_testfile = '../../bin/smurf/makemap'
 testfile_to_starlink = '../../../'
 
 starpath = None
-env = None
+
+# Cache of commands with their $<PACKAGE>_DIR variables replaced,
+# along with the variable values used (see _resolve_command).
+_resolved_commands = {}
+
+# Cache of 'key=' prefixes for keyword arguments.
+_keyword_prefixes = {}
 
 
 # Find STARLINK_DIR, or warn user to check.
@@ -1086,11 +1406,19 @@ else:
         else:
             logger.warning('Could not find Starlink: please run {}.change_starpath("/path/to/star")'.format(__name__))
 
-# ADAM_USER: set this to temporary directory in the current directory,
-# that should be automatically deleted when python closes.
-adamdir = os.path.relpath(tempfile.mkdtemp(prefix='tmpADAM', dir=os.getcwd()))
-atexit.register(shutil.rmtree, adamdir)
+# ADAM_USER: this is a temporary directory in the current directory,
+# that is only created when it is first needed (see _get_main_adamdir).
+
+# ADAM directories for threads other than the main one. Each starcomm
+# call takes one from _free_adamdirs (or makes a new one), and gives it
+# back afterwards, so directories are reused across threads and calls.
+# _pool_adamdirs holds every pooled directory, in use or not.
+_free_adamdirs = []
+_pool_adamdirs = set()
+atexit.register(_remove_pool_adamdirs)
+
+# Guards creating the main adamdir, env and the pooled directories.
+_adamdir_lock = threading.RLock()
 
-# If we found a starpath, set it up
-if starpath:
-    env = setup_starlink_environ(starpath,  adamdir)
+# The module level env is not set up until it is first needed (see
+# _get_env).